@@ -0,0 +1,79 @@
+"""Uniform-bin histogram kernels for the temperature cube."""
+import numpy as np
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+    prange = range
+
+
+def scan_numba(cube, n_bins, lo, hi, left, right):
+    """Histogram counts and statistics of every frame of `cube` in one pass.
+
+    Non-finite values are skipped in place, without a filtered copy. For
+    each frame along the first axis returns the counts on `n_bins` uniform
+    bins between `lo` and `hi`, the sum and number of valid points and the
+    number of points below `left` and above `right`. `fastmath` is limited
+    so that the finiteness test is not optimized away.
+    """
+    n_frames = cube.shape[0]
+    # single precision bounds keep the inner loop in float32
+    lo32 = np.float32(lo)
+    hi32 = np.float32(hi)
+    left32 = np.float32(left)
+    right32 = np.float32(right)
+    inv_width = np.float32(n_bins / (hi - lo))
+
+    counts = np.zeros((n_frames, n_bins), np.int64)
+    sums = np.zeros(n_frames)
+    n_valid = np.zeros(n_frames, np.int64)
+    n_cold = np.zeros(n_frames, np.int64)
+    n_hot = np.zeros(n_frames, np.int64)
+    for t in prange(n_frames):
+        frame = cube[t].ravel()
+        for i in range(frame.size):
+            v = frame[i]
+            if not np.isfinite(v):
+                continue
+            sums[t] += v
+            n_valid[t] += 1
+            if v < left32:
+                n_cold[t] += 1
+            elif v > right32:
+                n_hot[t] += 1
+            # like np.histogram, the last bin includes its right edge
+            if lo32 <= v <= hi32:
+                k = min(int((v - lo32) * inv_width), n_bins - 1)
+                counts[t, k] += 1
+
+    return counts, sums, n_valid, n_cold, n_hot
+
+
+def scan_numpy(cube, n_bins, lo, hi, left, right):
+    """NumPy version of `scan_numba`, used when Numba is not installed."""
+    n_frames = cube.shape[0]
+    flat = cube.reshape(n_frames, -1)
+    valid = np.isfinite(flat)
+    sums = np.sum(flat, axis=1, where=valid, dtype=np.float64)
+    n_valid = valid.sum(axis=1)
+    n_cold = (valid & (flat < left)).sum(axis=1)
+    n_hot = (valid & (flat > right)).sum(axis=1)
+
+    # non-finite and out of range values are dropped, like np.histogram the
+    # last bin includes its right edge
+    in_range = (flat >= lo) & (flat <= hi)
+    k = np.minimum(np.floor((flat - lo) * (n_bins / (hi - lo))), n_bins - 1)
+    k += n_bins * np.arange(n_frames)[:, None]
+    counts = np.bincount(k[in_range].astype(np.intp),
+                         minlength=n_frames * n_bins)
+
+    return counts.reshape(n_frames, n_bins), sums, n_valid, n_cold, n_hot
+
+
+if njit is None:
+    scan = scan_numpy
+else:
+    scan = njit('(float32[:, :, ::1], int64, float64, float64, float64, '
+                'float64)', parallel=True, fastmath={'contract', 'reassoc'},
+                cache=True)(scan_numba)
@@ -1,20 +1,24 @@
 """Visualization of temperature extremes via histograms."""
+from calendar import month_abbr
 from datetime import datetime
-from dateutil.relativedelta import relativedelta
 import logging
 from matplotlib.patches import Patch
-from matplotlib.patches import Rectangle
 import matplotlib.pyplot as plt
+from multiprocessing import get_context
 import numpy as np
 import os
-import requests
-from scipy.misc import imread
+from PIL import Image, ImageOps
+import shutil
+import subprocess
 import xarray as xr
 
 LOG_FMT = "%(levelname)s %(asctime)s - %(message)s"
 logging.basicConfig(level=logging.INFO, format=LOG_FMT)
 logger = logging.getLogger()
 
+# figure and artists reused by the current frame rendering process
+_frame = {}
+
 
 def download_input():
     """Download data used in plot."""
@@ -23,9 +27,13 @@ def download_input():
     savedir = './data'
     fn = '{}/{}'.format(savedir, url.split('/')[-1])
     if not os.path.isfile(fn):
+        # only needed when the file is missing
+        import requests
+
         logger.info('attempting to download : %s', url)
         try:
-            r = requests.get(url)
+            r = requests.get(url, stream=True)
+            r.raise_for_status()
         except Exception as exc:
             logger.error('Unable to download from: %s, exception: %s',
                          url,
@@ -33,14 +41,19 @@ def download_input():
             return None
 
         logger.debug('saving file : %s', fn)
+        # streamed to a temporary name so that a failed transfer doesn't
+        # leave a truncated file behind that looks already downloaded
+        part_fn = fn + '.part'
         try:
-            with open('{}'.format(fn), 'wb') as f:
-                for chunk in r.iter_content(chunk_size=1024):
-                    if chunk:  # filter out keep-alive new chunks
-                        f.write(chunk)
+            with r, open(part_fn, 'wb') as f:
+                r.raw.decode_content = True
+                shutil.copyfileobj(r.raw, f, length=1 << 20)
+            os.replace(part_fn, fn)
             logger.info('Sucessfully saved: %s', fn)
         except Exception as exc:
             logger.error('Unable to save file: %s, exception: %s', fn, exc)
+            if os.path.isfile(part_fn):
+                os.unlink(part_fn)
             return None
     else:
         logger.info('%s already downloaded', url)
@@ -48,6 +61,115 @@ def download_input():
     return fn
 
 
+def init_worker(params):
+    """Build the figure reused for all frames rendered by a worker process."""
+    bins = params['bins']
+    cold_idx = params['cold_idx']
+    hot_idx = params['hot_idx']
+    left_line = params['left_line']
+    right_line = params['right_line']
+    min_val = params['min_val']
+    max_val = params['max_val']
+    cold_color = params['cold_color']
+    hot_color = params['hot_color']
+
+    plt.rcParams['font.weight'] = 'bold'
+    plt.style.use('dark_background')
+    # axes stay transparent so the wallpaper shows through, also after the
+    # pie axes is cleared
+    plt.rcParams['axes.facecolor'] = 'none'
+    # frames are grabbed from the canvas, so it is built at the output size
+    width, height = params['frame_size']
+    fig = plt.figure(figsize=(width / 80, height / 80), dpi=80)
+
+    # histogram bars, heights are set for each frame
+    bars = plt.bar(bins[:-1], np.zeros(bins.size - 1),
+                   width=params['widths'], align='edge',
+                   facecolor='dimgray', zorder=1)
+
+    # plot the vertical lines for mean, median and right/left limits
+    plt.axvline(x=left_line, color='white', linestyle='--',
+                linewidth=0.5)
+    plt.axvline(x=right_line, color='white', linestyle='--',
+                linewidth=0.5)
+    mean_line = plt.axvline(x=0, color='orange', linestyle='-',
+                            linewidth=4, label='Mean')
+
+    # Color under the histogram before `left_line` and after `right_line`
+    cold_bars = plt.bar(bins[cold_idx], np.zeros(cold_idx.size),
+                        width=params['cold_widths'], align='edge',
+                        linewidth=1, edgecolor=cold_color,
+                        facecolor=cold_color)
+    hot_bars = plt.bar(params['hot_lefts'], np.zeros(hot_idx.size),
+                       width=params['hot_widths'], align='edge',
+                       linewidth=1, edgecolor=hot_color, facecolor=hot_color)
+
+    # some plot configuration
+    plt.ylim([0, 1])
+    plt.yticks(fontsize=8)
+    plt.xticks(fontsize=8)
+    plt.xlim(min_val, max_val)
+    # some labeling
+    plt.ylabel('Frequency of ocurrence')
+    plt.xlabel('Temperature Anomalies ($^\circ$C)')
+    title = 'Monthly Temp Histogram \n Data: Berkeley Earth'
+    plt.title(title)
+    year_text = plt.text(min_val + 0.8, 0.9, '', weight='bold', fontsize=24)
+    month_text = plt.text(min_val + 0.1, 0.9, '', fontsize=10)
+
+    hot_patch = Patch(color=hot_color, label='Warm Events')
+    cold_patch = Patch(color=cold_color, label='Cold Events')
+    mean_patch = Patch(color='orange', label='Mean')
+
+    plt.legend(handles=[hot_patch, cold_patch, mean_patch],
+               loc='upper right')
+    # laid out once, before the inset axes that tight_layout can't handle
+    plt.tight_layout()
+
+    pie_ax = plt.axes([.09, .31, .3, .3])
+
+    plt.figimage(params['wallpaper'], 0, 0, alpha=0.9, zorder=-1)
+
+    _frame.update(fig=fig, bars=bars, mean_line=mean_line,
+                  cold_idx=cold_idx, cold_bars=cold_bars,
+                  hot_idx=hot_idx, hot_bars=hot_bars,
+                  year_text=year_text, month_text=month_text, pie_ax=pie_ax,
+                  pie_colors=[cold_color, hot_color],
+                  out_dir=params['out_dir'])
+
+
+def render_frame(args):
+    """Update the worker figure for a single frame and save it."""
+    t, year, month, n, mean, num_cold_points, num_hot_points = args
+    logger.info('Generating frame for date: %s %s', month, year)
+
+    for rect, height in zip(_frame['bars'], n):
+        rect.set_height(height)
+    for rect, height in zip(_frame['cold_bars'], n[_frame['cold_idx']]):
+        rect.set_height(height)
+    for rect, height in zip(_frame['hot_bars'], n[_frame['hot_idx']]):
+        rect.set_height(height)
+    _frame['mean_line'].set_xdata([mean, mean])
+    _frame['year_text'].set_text(year)
+    _frame['month_text'].set_text(month)
+
+    # ploting frequency bars, wedges can't be updated in place
+    pie_ax = _frame['pie_ax']
+    pie_ax.cla()
+    pie_ax.pie([num_cold_points, num_hot_points],
+               colors=_frame['pie_colors'],
+               autopct='%1.1f%%', startangle=90.)
+    pie_ax.set_title('Accumulated \nFrequencies')
+    pie_ax.axis('equal')
+
+    out_name = 'plot_{0:04d}.jpg'.format(t)
+    fig = _frame['fig']
+    fig.canvas.draw()
+    frame = np.asarray(fig.canvas.buffer_rgba())[:, :, :3]
+    Image.fromarray(frame).save(
+        '{}/{}'.format(_frame['out_dir'], out_name), 'JPEG', quality=80)
+
+
 def make_plots(fn, animated_gif='histogram.gif', start='185001', end='201801'):
     """Create Histograms plot."""
     # plot parameters
@@ -59,129 +181,99 @@ def make_plots(fn, animated_gif='histogram.gif', start='185001', end='201801'):
     cold_color = 'royalblue'
     hot_color = 'orangered'
     out_dir = './pngs'
-    wallpaper = imread('earth.jpg')
+    time_block = 12
+    frame_size = (680, 420)
+    # resized once here instead of by every figimage call, cropped to the
+    # frame aspect ratio so it isn't stretched
+    wallpaper = np.asarray(ImageOps.fit(Image.open('earth.jpg'), frame_size,
+                                        Image.BILINEAR))
 
     if not os.path.exists(out_dir):
         os.makedirs(out_dir)
     for file in os.scandir(out_dir):
         os.unlink(file)
-    num_cold_points = 0.
-    num_hot_points = 0.
-    plt.rcParams['font.weight'] = 'bold'
     # plot code
-    ds = xr.open_dataset(fn)
-    d0 = datetime(1850, 1, 1)
+    # times are only used through their count, skip decoding them
+    ds = xr.open_dataset(fn, decode_times=False)
+    # time index counts months since January 1850
+    first_year = 1850
 
     if start == 'start':
-        start = d0
+        start_idx = 0
     else:
         start = datetime.strptime(start, '%Y%m')
+        start_idx = 12 * (start.year - first_year) + start.month - 1
     if end == 'end':
-        end = d0 + relativedelta(months=ds.coords['time'].size)
+        end_idx = ds.sizes['time']
     else:
         end = datetime.strptime(end, '%Y%m')
+        end_idx = 12 * (end.year - first_year) + end.month - 1
+    if start_idx >= end_idx:
+        logger.warning('No frames to plot for time indices %d to %d',
+                       start_idx, end_idx)
+        return
+
+    # bin geometry is the same for every frame, the bins under the cold and
+    # hot tails have their edge bin clipped to `left_line` and `right_line`
+    bins = np.linspace(min_val, max_val, n_bins + 1)
+    widths = np.diff(bins)
+    cold_idx = np.nonzero(bins[:-1] < left_line)[0]
+    cold_widths = np.minimum(bins[cold_idx + 1], left_line) - bins[cold_idx]
+    hot_idx = np.nonzero(bins[1:] >= right_line)[0]
+    hot_lefts = np.maximum(bins[hot_idx], right_line)
+    hot_widths = bins[hot_idx + 1] - hot_lefts
+
+    # kept out of the module imports so that frame workers don't load Numba
+    from fasthist import scan
+
+    # histograms and accumulated counts are computed up-front so that the
+    # frames can be rendered independently. The period is read one year at
+    # a time, which bounds memory while keeping reads large; anomalies are
+    # within a few tens of degrees so float32 is plenty
+    results = []
+    for block_start in range(start_idx, end_idx, time_block):
+        block_end = min(block_start + time_block, end_idx)
+        temp = np.ascontiguousarray(
+            ds['temperature'][block_start:block_end].values, dtype=np.float32)
+        results.append(scan(temp, n_bins, min_val, max_val,
+                            left_line, right_line))
+    counts, sums, n_valid, n_cold, n_hot = [np.concatenate(r)
+                                            for r in zip(*results)]
+    n = counts / (counts.sum(axis=1, keepdims=True) * widths[0])
+    means = sums / n_valid
+    num_cold_points = np.cumsum(n_cold)
+    num_hot_points = np.cumsum(n_hot)
+    frames = [(t, str(first_year + t // 12), month_abbr[t % 12 + 1], n[i],
+               means[i], num_cold_points[i], num_hot_points[i])
+              for i, t in enumerate(range(start_idx, end_idx))]
 
-    start_idx = 12 * relativedelta(start, d0).years +\
-        relativedelta(start, d0).months
-    end_idx = 12 * relativedelta(end, d0).years +\
-        relativedelta(end, d0).months
-
-    for t in range(start_idx, end_idx):
-        plt.close('all')
-        plt.style.use('dark_background')
-        plt.tight_layout(True)
-
-        month = d0 + relativedelta(months=t)
-        logger.info('Generating frame for date: %s', month.strftime('%b %Y'))
-
-        # load data
-        data = ds['temperature'][t, :, :].values.flatten()
-        data = data[~np.isnan(data)]
-
-        # plot
-        n, bins, patches = plt.hist(data, n_bins, facecolor='dimgray',
-                                    density=1, zorder=1)
-
-        # plot the vertical lines for mean, median and right/left limits
-        plt.axvline(x=left_line, color='white', linestyle='--',
-                    linewidth=0.5)
-        plt.axvline(x=right_line, color='white', linestyle='--',
-                    linewidth=0.5)
-        plt.axvline(x=np.mean(data), color='orange', linestyle='-',
-                    linewidth=4, label='Mean')
-
-        # Color under the histogram before `left_line` and after `right_line`
-        for index, item in enumerate(zip(bins[:-1], n)):
-            width = bins[index+1]-bins[index]
-            height = n[index]
-            if bins[index] < left_line:
-                if bins[index+1] > left_line:
-                    width = left_line - bins[index]
-                xy = (item[0], 0)
-                box = Rectangle(xy, width, height, linewidth=1,
-                                edgecolor=cold_color, facecolor=cold_color)
-                currentAxis = plt.gca()
-                currentAxis.add_patch(box)
-
-            if bins[index + 1] >= right_line:
-                if bins[index] < right_line:
-                    xy = (right_line, 0)
-                    width = bins[index + 1] - right_line
-                else:
-                    xy = (item[0], 0)
-
-                box = Rectangle(xy, width, height, linewidth=1,
-                                edgecolor=hot_color, facecolor=hot_color)
-                currentAxis = plt.gca()
-                currentAxis.add_patch(box)
-
-        # some plot configuration
-        plt.ylim([0, 1])
-        plt.yticks(fontsize=8)
-        plt.xticks(fontsize=8)
-        plt.xlim(min_val, max_val)
-        # some labeling
-        plt.ylabel('Frequency of ocurrence')
-        plt.xlabel('Temperature Anomalies ($^\circ$C)')
-        title = 'Monthly Temp Histogram \n Data: Berkeley Earth'
-        plt.title(title)
-        plt.text(min_val + 0.8, 0.9, month.strftime('%Y'),
-                 weight='bold', fontsize=24)
-        plt.text(min_val + 0.1, 0.9, month.strftime('%b'),
-                 fontsize=10)
-
-        # counting and ploting frequency bars
-        num_cold_points += data[np.where(data < left_line)].shape[0]
-        num_hot_points += data[np.where(data > right_line)].shape[0]
-        pie_slices = [num_cold_points, num_hot_points]
-        pie_colors = [cold_color, hot_color]
-
-        hot_patch = Patch(color=hot_color, label='Warm Events')
-        cold_patch = Patch(color=cold_color, label='Cold Events')
-        mean_patch = Patch(color='orange', label='Mean')
-
-        plt.legend(handles=[hot_patch, cold_patch, mean_patch],
-                   loc='upper right')
-
-        plt.axes([.09, .31, .3, .3], facecolor='k')
-        plt.pie(pie_slices, colors=pie_colors,
-                autopct='%1.1f%%', startangle=90.)
-        plt.title('Accumulated \nFrequencies')
-        plt.axis('equal')
-
-        out_name = 'plot_{0:04d}.jpg'.format(t)
-        plt.figimage(wallpaper, 0, 0, alpha=0.9, zorder=0, resize=(800, 600))
-        plt.savefig('{}/{}'.format(out_dir, out_name), transparent=True,
-                    dpi=80, rasterized=True)
+    params = {'bins': bins, 'widths': widths,
+              'cold_idx': cold_idx, 'cold_widths': cold_widths,
+              'hot_idx': hot_idx, 'hot_lefts': hot_lefts,
+              'hot_widths': hot_widths,
+              'left_line': left_line, 'right_line': right_line,
+              'min_val': min_val, 'max_val': max_val,
+              'cold_color': cold_color, 'hot_color': hot_color,
+              'out_dir': out_dir, 'frame_size': frame_size,
+              'wallpaper': wallpaper}
+    # Numba's threading layer is not fork safe, workers are spawned instead.
+    # Each worker builds its own figure, so don't start more than needed
+    processes = min(os.cpu_count(), len(frames))
+    with get_context('spawn').Pool(processes=processes,
+                                   initializer=init_worker,
+                                   initargs=(params,)) as pool:
+        pool.map(render_frame, frames)
 
     # anim stuff
     if animated_gif:
         logger.info('Generating animated gif %s', animated_gif)
         try:
-            cmd = 'convert -delay 10 -loop 0 -geometry 680x420 -quality 80% '\
-                '-fuzz 10% -layers Optimize {0}/*jpg {1}'.format(out_dir,
-                                                                 animated_gif)
-            os.system(cmd)
+            subprocess.run(['ffmpeg', '-y', '-loglevel', 'error',
+                            '-framerate', '10', '-pattern_type', 'glob',
+                            '-i', '{}/*.jpg'.format(out_dir),
+                            '-vf', 'split[a][b];[a]palettegen[p];'
+                                   '[b][p]paletteuse',
+                            '-loop', '0', animated_gif], check=True)
         except Exception as exc:
             logger.error('Unable to generate gif. Exception = %s', exc)
 